@@ -40,4 +40,8 @@ setup(
         'PyGObject',
         # 'SpiceClientGLib' -- Not sure how to express this here.
     ],
+    extras_require = {
+        'numba': ['numpy', 'numba'],
+        'opencv': ['numpy', 'opencv-python-headless'],
+    },
 )
@@ -1,4 +1,5 @@
 import argparse
+import itertools
 import libvirt
 import logging
 import os
@@ -47,20 +48,23 @@ def lookup_domain(conn, key):
 
 def unique_filename(path):
     base, ext = os.path.splitext(path)
-    idx = None
-
-    while True:
-        if idx is not None:
-            path = "{}_{}{}".format(base, idx, ext)
-        else:
-            path = base + ext
 
+    def try_create(path):
         try:
-            f = open(path, 'x')
-            f.close()
-            return path
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
         except FileExistsError:
-            idx = 0 if (idx is None) else (idx + 1)
+            return False
+        os.close(fd)
+        return True
+
+    path = base + ext
+    if try_create(path):
+        return path
+
+    for idx in itertools.count(0):
+        path = "{}_{}{}".format(base, idx, ext)
+        if try_create(path):
+            return path
 
 
 
@@ -69,8 +73,9 @@ def parse_args():
     ap = argparse.ArgumentParser()
 
     # Recording options
-    ap.add_argument('--vcodec', default='libx264',
-            help='Set the output video codec (see "ffmpeg -encoders" for choices)')
+    ap.add_argument('--vcodec',
+            help='Set the output video codec (see "ffmpeg -encoders" for choices; '
+                 'default=first usable of {})'.format(', '.join(record.ENCODER_CANDIDATES)))
     ap.add_argument('--loglevel', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
             help='Set the logging level (default=WARNING)', default='WARNING')
     ap.add_argument('-r', '--framerate', type=int, default=24)
@@ -111,6 +116,10 @@ def _main():
     if not args.output:
         args.output = unique_filename(dom.name() + '.mp4')
 
+    if not args.vcodec:
+        args.vcodec = record.detect_encoder()
+        logging.info("Using video codec %s", args.vcodec)
+
     record.record(args, dom)
 
 
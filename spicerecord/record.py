@@ -11,7 +11,12 @@
 # - https://ffmpeg.org/ffmpeg-filters.html
 # - https://ffmpeg.org/ffmpeg-filters.html#scale
 # - https://ffmpeg.org/ffmpeg-filters.html#concat
+# - https://trac.ffmpeg.org/wiki/Concatenate
+import concurrent.futures
+import io
 import logging
+import queue
+import threading
 import time
 import ctypes
 from enum import Enum
@@ -32,15 +37,30 @@ import gi
 gi.require_version('SpiceClientGLib', '2.0')
 from gi.repository import SpiceClientGLib
 
+# Optional: OpenCV or Numba (both of which require NumPy) enable in-process
+# BGRx -> YUV 4:2:0 conversion
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
 
 # Output H.264 pixel format
 # yuv444p is the default, but yuv420p is recommended for outdated media players.
-# However, yuv420p requires H and W divisible by 2.
-# We use yuv444p as the intermediate format when necessary, and re-encode to yuv420p with padding.
+# However, yuv420p requires H and W divisible by 2, so odd-sized displays are
+# padded to even sizes when the intermediate video is encoded.
 # https://github.com/mirror/x264/blob/90a61ec764/encoder/encoder.c#L501
-H264_PIX_FMT_INTERMEDIATE = lambda disp: (
-    'yuv420p' if disp.height % 2 == 0 and disp.width % 2 == 0 else 'yuv444p')
-H264_PIX_FMT_FINAL = 'yuv420p'
+H264_PIX_FMT = 'yuv420p'
 
 
 
@@ -62,6 +82,28 @@ class SpiceSurfaceFmt(Enum):
     SPICE_SURFACE_FMT_32_ARGB = 96
 
 
+if numba is not None:
+    @numba.njit(parallel=True, cache=True, fastmath=True)
+    def bgrx_to_i420(bgrx, y, u, v):
+        """Convert a BGRx image to I420 planes, using BT.601 fixed-point math
+
+        Like OpenCV's COLOR_BGRA2YUV_I420, each chroma sample is computed from
+        the top-left pixel of its 2x2 block.
+        """
+        h, w = y.shape
+        for row in numba.prange(h):
+            for col in range(w):
+                b = np.int32(bgrx[row, col, 0])
+                g = np.int32(bgrx[row, col, 1])
+                r = np.int32(bgrx[row, col, 2])
+                y[row, col] = ((66 * r + 129 * g + 25 * b + 128) >> 8) + 16
+                if row % 2 == 0 and col % 2 == 0:
+                    u[row // 2, col // 2] = ((-38 * r - 74 * g + 112 * b + 128) >> 8) + 128
+                    v[row // 2, col // 2] = ((112 * r - 94 * g - 18 * b + 128) >> 8) + 128
+else:
+    bgrx_to_i420 = None
+
+
 class Display(GObject.GObject):
     def __init__(self, index, channel, width, height, stride, shmid, imgdata, outfile):
         self.index   = index
@@ -75,8 +117,17 @@ class Display(GObject.GObject):
         # stride [bytes] == width [pixels] * 4 [bytes / pixel]
         assert(self.stride == self.width * self.bytes_per_pixel)
 
+        # Note: Frames can't be shared with ffmpeg via shmid: spice-gtk
+        # allocates the primary surface in-process (shmid is -1), and the
+        # rawvideo demuxer reads its input once rather than sampling a
+        # changing buffer. So each frame is still sent through a pipe.
+        #
+        # Wrap the primary surface in a memoryview once, so each frame can be
+        # handed to write() via the buffer protocol without any copying.
         imgdata_bytes = stride * height
-        self.imgdata = ctypes.cast(imgdata, ctypes.POINTER(ctypes.c_ubyte * imgdata_bytes))
+        self.imgdata = ctypes.cast(imgdata, ctypes.c_void_p).value
+        self._buf = (ctypes.c_ubyte * imgdata_bytes).from_address(self.imgdata)
+        self._mv = memoryview(self._buf).cast('B')
 
         self.outfile = outfile(self) if callable(outfile) else outfile
 
@@ -86,33 +137,50 @@ class Display(GObject.GObject):
 
 
     @staticmethod
-    def get_format_class(format):
-        return {
+    def get_format_class(format, width, height):
+        cls = {
             SpiceSurfaceFmt.SPICE_SURFACE_FMT_32_xRGB:  Display32RGB,
             # TODO: Other formats
         }[format]
 
+        # Convert to yuv420p ourselves when we can do so quickly, to reduce
+        # pipe bandwidth. (Plain NumPy is too slow to keep up at 1080p.)
+        if cls is Display32RGB and Display32RGB_YUV.available() and \
+                width % 2 == 0 and height % 2 == 0:
+            cls = Display32RGB_YUV
+        return cls
+
     def __repr__(self):
         return '{}(channel={}, width={}, height={}, stride={}, shmid={}, ' \
-               'imgdata={}, outfile={})'.format(
+               'imgdata={:#x}, outfile={})'.format(
                 type(self), self.channel, self.width, self.height, self.stride,
-                self.shmid, self.imgdata, self.outfile)
+                self.shmid, self.imgdata or 0, self.outfile)
 
 
     def destroy(self):
-        # Doesn't actually destroy anything -- called on destroy callback
+        # Called on destroy callback, after which SPICE frees the surface.
+        # Drop our view of it, so a write after this fails loudly instead of
+        # reading freed memory.
+        self._mv.release()
+        self._mv = None
+        self._buf = None
         self.imgdata = None
         self._end_time = time.time()
 
     def write_frame(self):
-        assert self.imgdata
+        # Only called while this is the active display, i.e. before destroy()
         b = self._do_write_frame()
         self._num_frames_recorded += 1
         return b
 
+    @property
+    def frames_dropped(self):
+        # Frames written but then dropped by the stream (see FFmpegRawStream)
+        return getattr(self.outfile, 'frames_dropped', 0)
+
     @property
     def frames_recorded(self):
-        return self._num_frames_recorded
+        return self._num_frames_recorded - self.frames_dropped
 
     @property
     def duration(self):
@@ -125,7 +193,50 @@ class Display32RGB(Display):
     ffmpeg_pix_fmt = 'bgr0'     # Each pixel is 4 bytes: BGR0,BGR0,...
 
     def _do_write_frame(self):
-        return self.outfile.write(self.imgdata.contents)
+        return self.outfile.write(self._mv)
+
+
+class Display32RGB_YUV(Display32RGB):
+    """A 32-bit BGRx display converted to planar YUV 4:2:0 (I420) before writing
+
+    This sends 1.5 bytes/pixel through the pipe instead of 4. Requires
+    OpenCV or Numba, and even width and height.
+    """
+    ffmpeg_pix_fmt = 'yuv420p'
+
+    @staticmethod
+    def available():
+        return cv2 is not None or bgrx_to_i420 is not None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        h, w = self.height, self.width
+
+        # View of the surface, reused for every frame
+        self._np = np.frombuffer(self._mv, dtype=np.uint8).reshape(h, w, 4)
+
+        # Output frame, reused for every frame: the Y, U, and V planes are
+        # views into one contiguous buffer, so a frame is a single write.
+        ysize, csize = h * w, (h // 2) * (w // 2)
+        self._frame = np.empty(ysize + 2 * csize, dtype=np.uint8)
+        self._y = self._frame[:ysize].reshape(h, w)
+        self._u = self._frame[ysize:ysize + csize].reshape(h // 2, w // 2)
+        self._v = self._frame[ysize + csize:].reshape(h // 2, w // 2)
+        # The same frame, in the layout used by OpenCV for I420
+        self._frame_cv = self._frame.reshape(h * 3 // 2, w)
+
+    def destroy(self):
+        # Drop our views first; the memoryview can't be released while exported
+        self._np = None
+        super().destroy()
+
+    def _do_write_frame(self):
+        if cv2:
+            cv2.cvtColor(self._np, cv2.COLOR_BGRA2YUV_I420, dst=self._frame_cv)
+        else:
+            bgrx_to_i420(self._np, self._y, self._u, self._v)
+
+        return self.outfile.write(self._frame)
 
 
 class SpiceRecorder(GObject.GObject):
@@ -134,7 +245,9 @@ class SpiceRecorder(GObject.GObject):
         "recording-stopped":    (GObject.SignalFlags.RUN_FIRST, None, [str]),
     }
 
-    def __init__(self, domain, framerate=24, create_display_stream=None):
+    def __init__(self, domain, framerate=24, *, create_display_stream):
+        # create_display_stream(display) returns a writable stream for the
+        # display's frames, with a .name (see FFmpegRawStream)
         GObject.GObject.__init__(self)
 
         self._vm = domain
@@ -148,12 +261,11 @@ class SpiceRecorder(GObject.GObject):
         self._displays = []             # displays created, in chrono. order
         self._active_display = None     # currently active display
 
-        self._last_periodic_update_t = None
-        self._num_frames_recorded = 0
         self._start_time = None
         self._record_timeout_id = None
+        self._periodic_timeout_id = None
 
-        self._create_display_stream = create_display_stream or self._create_display_tmpfile
+        self._create_display_stream = create_display_stream
 
     def _get_fd_for_open(self):
         # Reference:
@@ -233,10 +345,6 @@ class SpiceRecorder(GObject.GObject):
             logging.debug('Main channel closed')
             self._stop_recording("Disconnected")
 
-    def _create_display_tmpfile(self, display):
-        return tempfile.NamedTemporaryFile('w+b', prefix='spice-record-',
-                suffix='{}x{}.raw'.format(display.width, display.height), delete=False)
-
     def _display_primary_create_cb(self, channel, format, width, height, stride, shmid, imgdata):
         format = SpiceSurfaceFmt(format)
         logging.debug("display-primary-create channel=%s format=%s %dx%d", channel, format, width, height)
@@ -245,74 +353,88 @@ class SpiceRecorder(GObject.GObject):
             return
 
         outf = self._create_display_stream
-        d = Display.get_format_class(format)(len(self._displays), channel, width, height, stride, shmid, imgdata, outf)
+        d = Display.get_format_class(format, width, height)(len(self._displays), channel, width, height, stride, shmid, imgdata, outf)
         logging.debug("New display: %s", d)
         self._active_display = d
         self._displays.append(d)
 
         self._start_recording()
+        self._start_recording_display(d)
 
 
     def _display_primary_destroy_cb(self, channel):
         logging.debug("display-primary-destroy channel %s", channel)
 
+        self._stop_recording_display()
         self._active_display.destroy()
         self._active_display = None
 
     def _start_recording(self):
-        if self._record_timeout_id != None:
+        if self._start_time != None:
             return
 
         self._start_time = time.time()
-        self._record_frame()
-        self._record_timeout_id = GLib.timeout_add(
-                int(1000 / self.framerate), self._record_frame)
-        logging.debug('_record_timeout_id = %d', self._record_timeout_id)
+
+        self._periodic_timeout_id = GLib.timeout_add_seconds(
+                1, self._periodic_update_cb)
 
         id_ = GLib.io_add_watch(
-                sys.stdin,
+                sys.stdin.fileno(),
                 GLib.PRIORITY_DEFAULT,
                 GLib.IOCondition.IN,
                 self._stdin_avail_cb,
                 )
 
-    def _stop_recording(self, reason=""):
+    def _start_recording_display(self, display):
+        record_frame = self._make_record_frame(display)
+        if not record_frame():
+            return
+        self._record_timeout_id = GLib.timeout_add(
+                int(1000 / self.framerate), record_frame)
+        logging.debug('_record_timeout_id = %d', self._record_timeout_id)
+
+    def _stop_recording_display(self):
         if self._record_timeout_id != None:
             logging.debug('Removing _record_timeout_id = %d', self._record_timeout_id)
             GLib.source_remove(self._record_timeout_id)
             self._record_timeout_id = None
 
+    def _stop_recording(self, reason=""):
+        self._stop_recording_display()
+
+        if self._periodic_timeout_id != None:
+            GLib.source_remove(self._periodic_timeout_id)
+            self._periodic_timeout_id = None
+
         self.emit("recording-stopped", reason)
         self._mainloop.quit()
 
 
-    def _record_frame(self):
-        now = time.time()
+    def _make_record_frame(self, display):
+        # The frame timer only runs while display is active, so the callback
+        # is bound to it directly, avoiding attribute lookups on every frame.
+        write_frame = display.write_frame
 
-        # Ugh, can we miss frames here while there is no display?
-        if not self._active_display:
-            return
-
-        # Write the frame!
-        b = self._active_display.write_frame()
-        self._num_frames_recorded += 1
-
-        # Perform periodic update
-        if self._last_periodic_update_t:
-            dt = now - self._last_periodic_update_t
-        if not self._last_periodic_update_t or (dt > 1.0):
-            self.emit("periodic-update")
-            self._last_periodic_update_t = now
+        def record_frame():
+            try:
+                write_frame()
+            except OSError as e:
+                logging.error("Failed to write frame: %s", e)
+                self._stop_recording("Error writing frame: {}".format(e))
+                return False
+            return True
+        return record_frame
 
+    def _periodic_update_cb(self):
+        self.emit("periodic-update")
         return True
 
-    def _stdin_avail_cb(self, cond, *data):
-        for c in sys.stdin.read():
-            c = c.upper()
-
-            if c == 'Q':
-                logging.info('Stopping on "Q" press')
-                self._stop_recording("Requested by user")
+    def _stdin_avail_cb(self, fd, cond, *data):
+        # Read raw bytes; no need for text decoding to look for a keypress
+        data = os.read(fd, 64)
+        if b'Q' in data.upper():
+            logging.info('Stopping on "Q" press')
+            self._stop_recording("Requested by user")
 
         return True
 
@@ -326,7 +448,7 @@ class SpiceRecorder(GObject.GObject):
 
     @property
     def frames_recorded(self):
-        return self._num_frames_recorded
+        return sum(d.frames_recorded for d in self._displays)
 
     @property
     def bytes_recorded(self):
@@ -383,75 +505,172 @@ def getsize_or_zero(path):
         return 0
 
 
-def convert_concat_videos(displays, framerate, outcodec, outpath, loglevel=None):
+# Name suffixes of FFmpeg's hardware-accelerated encoders
+HW_ENCODER_SUFFIXES = ('_nvenc', '_qsv', '_vaapi', '_amf', '_videotoolbox',
+                       '_v4l2m2m', '_mf', '_omx')
+
+def is_hardware_encoder(codec):
+    return codec.endswith(HW_ENCODER_SUFFIXES)
+
+
+def concat_copy_videos(paths, outpath, listpath, loglevel=None):
+    """Concatenate videos with identical parameters, without re-encoding"""
+    # https://trac.ffmpeg.org/wiki/Concatenate#demuxer
+    with open(listpath, 'w') as f:
+        for path in paths:
+            f.write("file '{}'\n".format(path.replace("'", "'\\''")))
+
     ffmpeg_args = [
         'ffmpeg',
         '-loglevel', loglevel,
         '-y',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', listpath,
+        '-c', 'copy',
+        outpath
     ]
+    logging.debug("Invoking FFMPEG: {}".format(ffmpeg_args))
+    subprocess.check_call(ffmpeg_args)
 
+
+def convert_concat_videos(displays, framerate, outcodec, outpath, tmpdir, loglevel=None):
     # Determine the output video resolution
     maxw, maxh = 0, 0
     for d in displays:
         maxw = max(maxw, d.width)
         maxh = max(maxh, d.height)
 
-    # The FFmpeg 'pad' filter can't handle odd sizes, ensure they're even
-    # TODO: Can we get rid of this now that we're using yuv444p?
+    # yuv420p (and the FFmpeg 'pad' filter) can't handle odd sizes, ensure they're even
     def align(x, align):
         return (x + align - 1) & ~(align - 1)
     maxw = align(maxw, 2)
     maxh = align(maxh, 2)
 
-    # Establish temporary mp4 input files
-    for d in displays:
-        ffmpeg_args += [
-            '-i', d.outfile.name,
-        ]
+    # 1) Convert each intermediate video to the final size and format.
+    #    These are independent, so run several at once.
+    def rescale(d):
+        path = os.path.join(tmpdir, '{:03}-final.nut'.format(d.index))
 
-    # Build our complex filtergraph:
-    # 1) Create appropriately scaled versions of each input stream named [v{i}]
-    filters = []
-    for i,d in enumerate(displays):
         # Explained:
-        #   [{i}:v]     Take the i'th input file's video stream,
         #   scale=      Scale it to w x h, maintaining aspect ratio,
         #               decreasing the output size if required to do so,
         #   pad=        And if so, pad it out to w x h, centering it in the frame.
-        #   [v{i}]      Name the output stream [v{i}]
-        filt = '[{i}:v] scale={w}:{h}:force_original_aspect_ratio=decrease,' \
-                'pad={w}:{h}:(ow-iw)/2:(oh-ih)/2  [v{i}]'.format(
-                i=i, w=maxw, h=maxh)
-        filters.append(filt)
-
-    # 2) Concatenate the [v{i}] videos to [outv]
-    # Explained:
-    #   [v{i}]      Take each of the [v{i}] scaled streams,
-    #   concat=     concatenate all 'n' of them together into one video output.
-    #   [outv]      Name the output stream [outv]
-    filt = ' '.join('[v{i}]'.format(i=i) for i in range(len(displays)))
-    filt += 'concat=n={n}:v=1:a=0 [outv]'.format(n=len(displays))
-    filters.append(filt)
-
-
-    ffmpeg_args += [
-        # Apply the compex filtergraph
-        '-filter_complex', '; '.join(filters),
-
-        # Specify output video parameters
-        '-vcodec', outcodec,
-        '-pix_fmt', H264_PIX_FMT_FINAL,
-
-        # Map the [outv] to the output file
-        '-map', '[outv]',
-        outpath
-    ]
-    logging.debug("Invoking FFMPEG: {}".format(ffmpeg_args))
-    subprocess.check_call(ffmpeg_args)
+        filt = 'scale={w}:{h}:force_original_aspect_ratio=decrease,' \
+                'pad={w}:{h}:(ow-iw)/2:(oh-ih)/2'.format(w=maxw, h=maxh)
+
+        ffmpeg_args = [
+            'ffmpeg',
+            '-loglevel', loglevel,
+            '-y',
+            '-i', d.outfile.name,
+            '-vf', filt,
+
+            # Specify output video parameters; these must be identical for
+            # all segments so they can be concatenated without re-encoding
+            '-r', str(framerate),
+            '-vcodec', outcodec,
+            '-pix_fmt', H264_PIX_FMT,
+            '-f', 'nut',
+            path
+        ]
+        logging.debug("Invoking FFMPEG: {}".format(ffmpeg_args))
+        subprocess.check_call(ffmpeg_args)
+        return path
+
+    # Each software ffmpeg encoder is itself multi-threaded; only use a
+    # fraction of the CPUs. Hardware encoders often limit concurrent sessions,
+    # so only run one at a time.
+    if is_hardware_encoder(outcodec):
+        workers = 1
+    else:
+        workers = max(1, (os.cpu_count() or 1) // 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
+        paths = list(ex.map(rescale, displays))
+
+    # 2) Concatenate the converted videos
+    concat_copy_videos(paths, outpath,
+            listpath = os.path.join(tmpdir, 'concat.txt'),
+            loglevel = loglevel,
+            )
+
+
+# H.264 encoders to try, in order of preference
+# (h264_vaapi is omitted: it needs a hwupload filter chain we don't build)
+ENCODER_CANDIDATES = ('h264_nvenc', 'h264_qsv', 'libx264')
+DEFAULT_ENCODER = 'libx264'
+
+def detect_encoder():
+    """Find the preferred H.264 encoder which FFmpeg can actually use here"""
+    try:
+        out = subprocess.check_output(['ffmpeg', '-hide_banner', '-encoders'],
+                stderr=subprocess.DEVNULL).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return DEFAULT_ENCODER
+    available = {line.split()[1] for line in out.splitlines()
+                 if len(line.split()) > 1}
+
+    for enc in ENCODER_CANDIDATES:
+        if enc not in available:
+            continue
+
+        # Being built into FFmpeg doesn't mean the hardware is present (or
+        # accepts our input), so try encoding a single frame.
+        probe_args = [
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', 'color=size=256x256',
+            '-frames:v', '1',
+            '-vcodec', enc,
+            '-pix_fmt', H264_PIX_FMT,
+        ] + realtime_encoder_args(enc) + [
+            '-f', 'null', '-',
+        ]
+        try:
+            subprocess.check_call(probe_args, timeout=10,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.SubprocessError):
+            logging.debug("Encoder %s is not usable", enc)
+            continue
+
+        logging.debug("Using encoder %s", enc)
+        return enc
+
+    return DEFAULT_ENCODER
+
+
+def prepare_frame_conversion():
+    """Do any one-time setup for in-process frame conversion
+
+    The Numba kernel is JIT-compiled on first use, which can take seconds;
+    do that now rather than in the GLib loop when the first display appears.
+    """
+    if Display32RGB_YUV.available() and cv2 is None:
+        bgrx = np.zeros((2, 2, 4), dtype=np.uint8)
+        frame = np.empty(6, dtype=np.uint8)
+        bgrx_to_i420(bgrx, frame[:4].reshape(2, 2),
+                frame[4:5].reshape(1, 1), frame[5:].reshape(1, 1))
+
+
+def realtime_encoder_args(codec):
+    """Get FFmpeg output options which tune an encoder for real-time capture
+
+    The recorded video is often used as the final output without re-encoding,
+    so these trade some encoding speed for reasonable compression.
+    """
+    if codec in ('libx264', 'libx265'):
+        return ['-preset', 'veryfast']
+    if codec == 'h264_nvenc':
+        return ['-delay', '0']
+    return []
+
 
 class FFmpegRawStream:
     """A stream of raw video to an FFMPEG process"""
 
+    QUEUE_FRAMES = 8    # Max frames buffered before dropping the oldest
+    NUM_BUFFERS = QUEUE_FRAMES + 1  # Queued, plus one being written
+
     def __init__(self, path, display, framerate, outcodec, loglevel):
         self.path = path
 
@@ -472,37 +691,135 @@ class FFmpegRawStream:
 
             # Specify output video parameters
             '-vcodec', outcodec,
-            '-pix_fmt', H264_PIX_FMT_INTERMEDIATE(display),
+            '-pix_fmt', H264_PIX_FMT,
+        ]
+
+        # yuv420p requires even dimensions; pad odd ones on the right/bottom
+        if display.width % 2 != 0 or display.height % 2 != 0:
+            ffmpeg_args += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2:0:0']
 
-            # Ouptut file,
+        # Encode fast enough to keep up with capture. Note that this video may
+        # become the final output (see _record), so don't sacrifice too much
+        # compression; the writer thread absorbs any encoder latency.
+        ffmpeg_args += realtime_encoder_args(outcodec)
+
+        ffmpeg_args += [
+            # Ouptut file, as NUT: unlike MP4, it needs no finalization and can
+            # be concatenated without re-encoding, and it can carry any codec.
+            '-f', 'nut',
             self.path,
         ]
         logging.debug("Invoking FFMPEG: {}".format(ffmpeg_args))
-        self.p = subprocess.Popen(ffmpeg_args, stdin=subprocess.PIPE)
+
+        # Frames are written directly to the pipe fd with os.write(), so
+        # there is no need for Python to buffer stdin.
+        self.p = subprocess.Popen(ffmpeg_args, stdin=subprocess.PIPE, bufsize=0)
+        self._stdin_fd = self.p.stdin.fileno()
+
+        # Frames are written to ffmpeg from a separate thread, so the GLib
+        # main loop never blocks on a full pipe.
+        # Frame buffers are allocated on demand (up to NUM_BUFFERS), and then
+        # recycled through _free.
+        self.frames_dropped = 0
+        self._error = None
+        self._num_buffers = 0
+        self._free = queue.Queue()
+        self._q = queue.Queue(maxsize=self.QUEUE_FRAMES)
+        self._thr = threading.Thread(target=self._drain, daemon=True)
+        self._thr.start()
 
     @property
     def name(self):
         # Mimics NamedTemporaryFile.name
         return self.path
 
+    def _write_all(self, data):
+        view = memoryview(data)
+        while view:
+            n = os.write(self._stdin_fd, view)
+            view = view[n:]
+
+    def _drain(self):
+        # Writer thread: feed queued frames to ffmpeg until the sentinel
+        try:
+            while True:
+                frame = self._q.get()
+                if frame is None:
+                    break
+                self._write_all(frame)
+                self._free.put(frame)
+        except Exception as e:
+            self._error = e
+
+    def _get_buffer(self, size):
+        # If the writer thread has fallen behind, drop the oldest queued frame.
+        # Only we add to the queue, so once it isn't full, it stays that way.
+        if self._q.full():
+            try:
+                self._free.put(self._q.get_nowait())
+                self.frames_dropped += 1
+                logging.debug("%s: writer behind; dropped a frame", self.path)
+            except queue.Empty:
+                pass
+
+        # With at most QUEUE_FRAMES - 1 frames queued and one being written,
+        # there is always a free buffer, or one yet to be allocated.
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            pass
+        assert self._num_buffers < self.NUM_BUFFERS
+        self._num_buffers += 1
+        return bytearray(size)
+
     def write(self, data):
-        return self.p.stdin.write(data)
+        """Queue one complete frame to be written to ffmpeg
+
+        The frame is copied into a recycled buffer, as data (e.g. a view of the
+        display surface) continues to change after this returns. If the writer
+        thread has fallen behind, the oldest queued frame is dropped.
+        Raises the writer thread's error if writing to ffmpeg has failed.
+        """
+        if not self._thr.is_alive():
+            raise self._error or BrokenPipeError("ffmpeg writer thread has exited")
+
+        frame = self._get_buffer(len(data))
+        memoryview(frame)[:] = data
+        self._q.put_nowait(frame)
+        return len(frame)
 
     def close(self):
-        self.p.stdin.close()
+        # Let the writer thread finish the queued frames, unless it has died
+        while self._thr.is_alive():
+            try:
+                self._q.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self._thr.join()
+        try:
+            self.p.stdin.close()
+        except BrokenPipeError:
+            pass
         rc = self.p.wait()
         if rc != 0:
             raise subprocess.CalledProcessError(rc, 'ffmpeg')
+        if self._error:
+            raise self._error
 
 
 def domain_extract_connect_info(domain):
     # See
     #   virt_viewer_extract_connect_info()
     #   virt_viewer_app_set_connect_info()
-    tree = ET.fromstring(domain.XMLDesc(libvirt.VIR_DOMAIN_XML_SECURE))
-    ET.dump(tree)
+    xmlstr = domain.XMLDesc(libvirt.VIR_DOMAIN_XML_SECURE)
 
-    gfx = tree.find('devices/graphics')
+    # Only parse as far as the first <graphics> element
+    gfx = None
+    for event, elem in ET.iterparse(io.StringIO(xmlstr), events=('end',)):
+        if elem.tag == 'graphics':
+            gfx = elem
+            break
 
     class ConnectInfo:
         pass
@@ -593,7 +910,7 @@ def format_datasize(b):
 
 def _record(args, dom, tmpdir):
     def create_ffmpeg_stream(display):
-        path = os.path.join(tmpdir, '{:03}-{}x{}.mp4'.format(
+        path = os.path.join(tmpdir, '{:03}-{}x{}.nut'.format(
             display.index, display.width, display.height))
         return FFmpegRawStream(
             path = path,
@@ -603,6 +920,8 @@ def _record(args, dom, tmpdir):
             loglevel = logging_to_ffmpeg_loglevel(args.loglevel),
             )
 
+    prepare_frame_conversion()
+
     domain_wait(dom, libvirt.VIR_DOMAIN_RUNNING)
 
     with TtyCbreakMode():
@@ -641,8 +960,9 @@ def _record(args, dom, tmpdir):
     qprint("Recorded displays:")
     maxw, maxh = 0, 0
     for n,d in enumerate(sp.displays):
-        qprint("  {}: {}x{} {:>4} frames  {:>10}  {:0.02f} sec".format(n, d.width, d.height,
+        qprint("  {}: {}x{} {:>4} frames ({} dropped)  {:>10}  {:0.02f} sec".format(n, d.width, d.height,
             d.frames_recorded,
+            d.frames_dropped,
             format_datasize(os.path.getsize(d.outfile.name)),
             d.duration))
         maxw = max(maxw, d.width)
@@ -654,13 +974,17 @@ def _record(args, dom, tmpdir):
     # Filter out displays with no frames
     displays = [d for d in sp.displays if d.frames_recorded]
 
-    if len(displays) == 1 and H264_PIX_FMT_INTERMEDIATE(displays[0]) == H264_PIX_FMT_FINAL:
-        # Optimization: use the only intermediate video as the final
-        d = displays[0]
-        src = d.outfile.name
-        d.outfile = None
-        logging.info("Moving {} to {}".format(src, args.output))
-        shutil.move(src, args.output)
+    if len({(d.width, d.height) for d in displays}) == 1:
+        # Optimization: all intermediate videos (or the only one) are already
+        # in the final size and format, so just concatenate (remux) them
+        # without re-encoding
+        qprint("\nDone recording. Concatenating...")
+        concat_copy_videos(
+                paths = [d.outfile.name for d in displays],
+                outpath = args.output,
+                listpath = os.path.join(tmpdir, 'concat.txt'),
+                loglevel = logging_to_ffmpeg_loglevel(args.loglevel),
+                )
 
     else:
         # Convert video
@@ -670,6 +994,7 @@ def _record(args, dom, tmpdir):
                 framerate = args.framerate,
                 outcodec = args.vcodec,
                 outpath = args.output,
+                tmpdir = tmpdir,
                 loglevel = logging_to_ffmpeg_loglevel(args.loglevel),
                 )
     qprint("\n{} written!".format(args.output))